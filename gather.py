@@ -1,6 +1,133 @@
-import requests, os, json, argparse, re
+import requests, os, json, argparse, shelve, threading, time, itertools, random
+from bisect import bisect_right
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from pathlib import Path
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def dumps_line(obj):
+    # compact single-line JSON for the checkpoint stream
+    if orjson:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, ensure_ascii=False)
+
+def loads_response(res):
+    # orjson decodes the raw bytes directly, skipping requests' charset
+    # detection and the slower stdlib decoder
+    if orjson:
+        return orjson.loads(res.content)
+    return json.loads(res.content)
+
+def write_json(path, obj):
+    # serialize to a sibling tmp file and rename into place, so an interrupt
+    # mid-write can never leave a truncated JSON behind
+    tmp = path.with_suffix(path.suffix + '.tmp')
+    # orjson serializes in one C pass and returns bytes; stdlib json with
+    # indent is the slowest configuration, so only fall back to it
+    if orjson:
+        tmp.write_bytes(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with tmp.open('w') as f:
+            json.dump(obj, f, ensure_ascii=False, indent=4)
+    os.replace(tmp, path)
+
+# commit entries stay resident in ms_l for the whole run; a namedtuple is
+# ~4x smaller than the equivalent dict and converts back via _asdict() at
+# serialization time
+CommitEntry = namedtuple('CommitEntry', ['message', 'date', 'link', 'diff'])
+
+def jsonable(ms_l):
+    # snapshot-time view of ms_l with CommitEntry rows expanded to dicts
+    out = []
+    for ms in ms_l:
+        d = dict(ms)
+        d['commits'] = {author_t: {'count': bucket['count'], 'list': [entry._asdict() for entry in bucket['list']]} for author_t, bucket in ms['commits'].items()}
+        out.append(d)
+    return out
+
+coauthor_prefix = 'Co-authored-by: '
+
+def find_coauthors(message_t):
+    # trailers sit on their own lines at the end of the message; a prefix check
+    # per line beats running the old r'Co-authored-by: (.*) <.*>' regex over
+    # the whole message, and most messages skip the split via the `in` guard
+    if coauthor_prefix not in message_t:
+        return []
+    coauthors = []
+    for line in message_t.split('\n'):
+        # trailing whitespace would defeat the endswith check below
+        line = line.rstrip()
+        if line.startswith(coauthor_prefix):
+            lt = line.rfind(' <')
+            if lt > len(coauthor_prefix) and line.endswith('>'):
+                coauthors.append(line[len(coauthor_prefix):lt])
+    return coauthors
+
+# bounded so concurrent diff fetches stay under GitHub's secondary rate limits
+diff_workers = 10
+# repos are independent and the work is network-bound, so they can overlap too
+repo_workers = 8
+# materialize the full nested JSON only every this many pages; the JSONL
+# checkpoint already captures every record in between
+pages_per_snapshot = 10
+
+# shelve is not safe for concurrent writers
+cache_lock = threading.Lock()
+
+# the 5000 req/hr budget is per token, so a pool in token.json
+# ({"tokens": [...]}) multiplies sustained throughput; requests round-robin
+# over it, None when zero or one token is configured
+token_cycle = None
+token_lock = threading.Lock()
+
+def next_auth_header():
+    if token_cycle is None:
+        return {}
+    with token_lock:
+        return {'Authorization': 'Bearer {}'.format(next(token_cycle))}
+
+# url -> {'etag': ..., 'content': ..., 'links': ...}; a 304 revalidation costs
+# ~200 bytes and does not count against the primary rate limit
+etag_cache = {}
+etag_lock = threading.Lock()
+
+# stand-in for a requests.Response served from the ETag cache; carries just
+# the two attributes the gather loops read
+CachedResponse = namedtuple('CachedResponse', ['content', 'links'])
+
+def load_etag_cache(data_path):
+    cache_path = data_path / '.etag_cache.json'
+    if cache_path.exists():
+        if orjson:
+            etag_cache.update(orjson.loads(cache_path.read_bytes()))
+        else:
+            with cache_path.open() as f:
+                etag_cache.update(json.load(f))
+
+def save_etag_cache(data_path):
+    write_json(data_path / '.etag_cache.json', etag_cache)
+
+# output timestamps are GMT+3, see gmt_str in main()
+tz_offset = timedelta(hours=3)
+
+def parse_github_date(s):
+    # REST timestamps are always 'YYYY-MM-DDTHH:MM:SSZ'; plain int slicing is
+    # ~3x faster than fromisoformat and this runs once per gathered record
+    if s.endswith('Z'):
+        date_t = datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]), tzinfo=timezone.utc)
+    else:
+        # GraphQL authoredDate keeps the author's own UTC offset
+        date_t = datetime.fromisoformat(s)
+    local = date_t + tz_offset
+    date_str = '%04d-%02d-%02d %02d:%02d:%02d' % (local.year, local.month, local.day, local.hour, local.minute, local.second)
+    return date_t, date_str
 
 def get_args():
     parser = argparse.ArgumentParser(description='Gather commits and issues from GitHub repositories')
@@ -8,20 +135,458 @@ def get_args():
     parser.add_argument('-r', '--repos', help='Path to the JSON file with the repositories', type=str, default='repos.json')
     parser.add_argument('-d', '--date', help='Path to the JSON file with the dates', type=str, default='dates.json')
     parser.add_argument('-o', '--output', help='Path to the output directory', type=str, default='commits-issues-prs')
+    parser.add_argument('--no-diffs', help='Skip fetching per-commit diff stats (saves one request per commit on tokenless runs)', action='store_true')
     return parser.parse_args()
 
-def get_diff(url, headers):
-    commit_req = requests.get(url, headers=headers)
-    commit_res = commit_req.json()
-    filenames = {file['filename'] for file in commit_res['files']}
-    total = commit_res['stats']['total']
-    return { 'filenames': filenames, 'total': total }
+def setup_github_auth(token_path):
+    token = None
+    if not token_path.exists():
+        token_needed = input('Do you need to access private repositories? (y/n): ')
+        if token_needed == 'y':
+            token = input('Enter your GitHub token: ')
+            with token_path.open('w') as f:
+                json.dump({'token': token}, f, ensure_ascii=False, indent=4)
+    else:
+        with token_path.open() as f:
+            content = json.load(f)
+            if 'tokens' in content.keys():
+                tokens = content['tokens']
+                token = tokens[0]
+                if len(tokens) > 1:
+                    global token_cycle
+                    token_cycle = itertools.cycle(tokens)
+            elif 'token' in content.keys():
+                token = content['token']
+            else:
+                print('Please add your GitHub token to the `token.json` file in the following format: {"token": "your_token"} (or {"tokens": [...]} for a pool)')
+                exit()
+    headers = { 'Accept': 'application/vnd.github.v3+json' }
+    if token:
+        headers['Authorization'] = 'Bearer {}'.format(token)
+    session = requests.Session()
+    session.headers.update(headers)
+    # transient gateway errors retry with backoff inside urllib3; 403/429
+    # stay with github_get, which understands GitHub's rate-limit headers
+    retries = Retry(total=5, backoff_factor=1, status_forcelist=[502, 503, 504], allowed_methods=['GET', 'POST'])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=64, max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+graphql_url = 'https://api.github.com/graphql'
+
+# one page of history per request, diff stats included, instead of one REST
+# request per commit on top of the listing page
+commit_history_query = '''
+query($owner: String!, $name: String!, $until: GitTimestamp!, $cursor: String) {
+    repository(owner: $owner, name: $name) {
+        defaultBranchRef {
+            target {
+                ... on Commit {
+                    history(first: 100, until: $until, after: $cursor) {
+                        pageInfo { hasNextPage endCursor }
+                        nodes {
+                            oid message authoredDate url
+                            additions deletions changedFilesIfAvailable
+                            author { user { login } name }
+                        }
+                    }
+                }
+            }
+        }
+    }
+}'''
+
+# explicit selection sets: the REST /issues payload is ~5KB per issue of
+# mostly unused fields, these return only what actually lands in the output
+issues_query = '''
+query($owner: String!, $name: String!, $cursor: String) {
+    repository(owner: $owner, name: $name) {
+        issues(first: 100, after: $cursor, states: [OPEN, CLOSED]) {
+            pageInfo { hasNextPage endCursor }
+            nodes {
+                title body createdAt state url
+                author { login }
+                labels(first: 20) { nodes { name } }
+                assignees(first: 20) { nodes { login } }
+                comments(first: 100) { nodes { author { login } body } }
+            }
+        }
+    }
+}'''
+
+prs_query = '''
+query($owner: String!, $name: String!, $cursor: String) {
+    repository(owner: $owner, name: $name) {
+        pullRequests(first: 100, after: $cursor, states: [OPEN, CLOSED, MERGED]) {
+            pageInfo { hasNextPage endCursor }
+            nodes {
+                title body createdAt state url
+                additions deletions changedFiles
+                author { login }
+                labels(first: 20) { nodes { name } }
+                assignees(first: 20) { nodes { login } }
+                comments(first: 100) { nodes { author { login } body } }
+            }
+        }
+    }
+}'''
+
+def rate_limit_sleep(res, attempts):
+    # shared backoff for rate-limited responses, REST and GraphQL alike
+    retry_after = res.headers.get('Retry-After')
+    if retry_after:
+        # scale the advertised wait on repeat offenses: consecutive 403s
+        # mean the secondary limiter is still unhappy
+        time.sleep(int(retry_after) * 2 ** (attempts - 1) + random.random())
+        return
+    if res.headers.get('X-RateLimit-Remaining') == '0':
+        reset = int(res.headers.get('X-RateLimit-Reset', '0'))
+        time.sleep(max(reset - time.time(), 1))
+        return
+    # secondary limit without headers: back off a minute, jittered so
+    # parallel repo workers don't all come back at once
+    time.sleep(60 + random.random() * 5)
+
+def github_get(session, url, cache=True):
+    # central REST entry point: revalidate against the ETag cache, back off
+    # when GitHub says so, and once the remaining budget runs low, pace
+    # requests so the bucket never empties and triggers the multi-minute
+    # secondary-limit stall
+    cached = None
+    if cache:
+        with etag_lock:
+            cached = etag_cache.get(url)
+    attempts = 0
+    while 1:
+        req_headers = next_auth_header()
+        if cached:
+            req_headers['If-None-Match'] = cached['etag']
+        res = session.get(url, headers=req_headers or None)
+        if res.status_code == 304:
+            return CachedResponse(cached['content'], cached['links'])
+        if res.status_code in (403, 429) and attempts < 3:
+            attempts += 1
+            rate_limit_sleep(res, attempts)
+            continue
+        remaining = int(res.headers.get('X-RateLimit-Remaining', '1000'))
+        if 0 < remaining < 50:
+            reset = int(res.headers.get('X-RateLimit-Reset', '0'))
+            wait = (reset - time.time()) / remaining
+            if wait > 0:
+                time.sleep(wait)
+        etag = res.headers.get('ETag')
+        if cache and etag and res.status_code == 200:
+            with etag_lock:
+                etag_cache[url] = {'etag': etag, 'content': res.content.decode('utf-8'), 'links': res.links}
+        return res
+
+def graphql(session, query, variables):
+    # same bounded backoff as github_get: a secondary-limit 403 here returns
+    # a message-only body whose missing data key would otherwise surface as
+    # a KeyError and take the whole repo pool down with it
+    attempts = 0
+    while 1:
+        res = session.post(graphql_url, json={'query': query, 'variables': variables}, headers=next_auth_header() or None)
+        if res.status_code in (403, 429) and attempts < 3:
+            attempts += 1
+            rate_limit_sleep(res, attempts)
+            continue
+        data = loads_response(res)
+        if 'errors' in data:
+            raise RuntimeError('GraphQL error: %s' % data['errors'][0]['message'])
+        if 'data' not in data:
+            if attempts < 3:
+                attempts += 1
+                rate_limit_sleep(res, attempts)
+                continue
+            raise RuntimeError('GraphQL error: %s' % data.get('message', 'HTTP %s' % res.status_code))
+        return data['data']
+
+def get_diff(url, session):
+    # no ETag caching here: commit details are immutable, disk-cached by SHA
+    # in fetch_diffs, and never refetched, so cached bodies (which carry the
+    # full per-file patch text) would only bloat .etag_cache.json
+    commit_req = github_get(session, url, cache=False)
+    commit_res = loads_response(commit_req)
+    # only the count is ever consumed, so don't keep the filenames around
+    return { 'files': len(commit_res['files']), 'total': commit_res['stats']['total'] }
+
+def fetch_diffs(session, executor, prev_diffs, diff_cache, urls_by_sha):
+    new_urls = {}
+    with cache_lock:
+        for sha, url in urls_by_sha.items():
+            if sha in prev_diffs:
+                continue
+            # commits are immutable, so a diff cached on disk by SHA never goes stale
+            if sha in diff_cache:
+                diff = diff_cache[sha]
+                if 'filenames' in diff:
+                    # entry cached by an older run that kept the full set
+                    diff = {'files': len(diff['filenames']), 'total': diff['total']}
+                prev_diffs[sha] = diff
+            else:
+                new_urls[sha] = url
+    if new_urls:
+        diffs = list(executor.map(lambda url: get_diff(url, session), new_urls.values()))
+        with cache_lock:
+            for sha, diff in zip(new_urls.keys(), diffs):
+                prev_diffs[sha] = diff
+                diff_cache[sha] = diff
+
+def add_commit(ms_l, ms_dates, checkpoint_f, date_t, authors, entry):
+    # ms_dates is sorted ascending; records on the boundary belong to the
+    # next milestone (strict <), which is exactly bisect_right
+    i = bisect_right(ms_dates, date_t)
+    if i == len(ms_dates):
+        return
+    commits_t = ms_l[i]['commits']
+    for author_t in authors:
+        bucket = commits_t.get(author_t)
+        if bucket is None:
+            bucket = commits_t[author_t] = { 'count': 0, 'list': [] }
+        bucket['list'].append(entry)
+        bucket['count'] += 1
+        checkpoint_f.write(dumps_line({'type': 'commit', 'ms': i, 'author': author_t, 'entry': entry._asdict()}) + '\n')
+
+def add_issue(ms_l, ms_dates, checkpoint_f, key_t, date_t, author_t, d):
+    i = bisect_right(ms_dates, date_t)
+    if i == len(ms_dates):
+        return
+    bucket = ms_l[i][key_t].get(author_t)
+    if bucket is None:
+        bucket = ms_l[i][key_t][author_t] = { 'count': 0, 'list': [] }
+    bucket['list'].append(d)
+    bucket['count'] += 1
+    checkpoint_f.write(dumps_line({'type': key_t, 'ms': i, 'author': author_t, 'entry': d}) + '\n')
+
+def gather_issues_and_prs_graphql(session, user_t, repo_t, ms_dates, ms_l, checkpoint_f, snapshot):
+    for key_t, conn_t, query in [('issues', 'issues', issues_query), ('prs', 'pullRequests', prs_query)]:
+        cursor = None
+        page_n = 0
+        while 1:
+            data = graphql(session, query, {'owner': user_t, 'name': repo_t, 'cursor': cursor})
+            conn = data['repository'][conn_t]
+            for issue in conn['nodes']:
+                date_t, date_str = parse_github_date(issue['createdAt'])
+                author_t = issue['author']['login'] if issue['author'] else 'ghost'
+                comments = [ { 'author': comment['author']['login'] if comment['author'] else 'ghost', 'body': comment['body'] } for comment in issue['comments']['nodes'] ]
+                # REST reports merged PRs as closed
+                state_t = 'closed' if issue['state'] == 'MERGED' else issue['state'].lower()
+                d = { 'title': issue['title'], 'desc': issue['body'], 'date': date_str, 'labels': [label['name'] for label in issue['labels']['nodes']], 'assignees': [assignee['login'] for assignee in issue['assignees']['nodes']], 'link': issue['url'], 'state': state_t, 'comments': comments }
+                if key_t == 'prs':
+                    d['diff'] = {'files': issue['changedFiles'], 'total': issue['additions'] + issue['deletions']}
+                add_issue(ms_l, ms_dates, checkpoint_f, key_t, date_t, author_t, d)
+            checkpoint_f.flush()
+            page_n += 1
+            if page_n % pages_per_snapshot == 0:
+                snapshot()
+            if not conn['pageInfo']['hasNextPage']:
+                break
+            cursor = conn['pageInfo']['endCursor']
+
+def gather_commits_graphql(session, user_t, repo_t, ms_dates, ms_l, checkpoint_f, snapshot):
+    until_str = ms_dates[-1].astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    cursor = None
+    page_n = 0
+    while 1:
+        data = graphql(session, commit_history_query, {'owner': user_t, 'name': repo_t, 'until': until_str, 'cursor': cursor})
+        ref = data['repository']['defaultBranchRef']
+        if ref is None:
+            break
+        history = ref['target']['history']
+        for commit in history['nodes']:
+            date_t, date_str = parse_github_date(commit['authoredDate'])
+            author = commit['author']
+            if author and author['user'] and author['user']['login']:
+                author_t = author['user']['login']
+            elif author and author['name']:
+                author_t = author['name']
+            else:
+                author_t = 'unknown'
+            message_t = commit['message']
+            coauthors = find_coauthors(message_t)
+            files = commit['changedFilesIfAvailable']
+            diff = {'files': files if files is not None else 0, 'total': commit['additions'] + commit['deletions']}
+            add_commit(ms_l, ms_dates, checkpoint_f, date_t, coauthors + [author_t], CommitEntry(message_t, date_str, commit['url'], diff))
+        checkpoint_f.flush()
+        page_n += 1
+        if page_n % pages_per_snapshot == 0:
+            snapshot()
+        if not history['pageInfo']['hasNextPage']:
+            break
+        cursor = history['pageInfo']['endCursor']
+
+def gather_commits(session, executor, user_t, repo_t, ms_dates, ms_l, checkpoint_f, snapshot, prev_diffs, diff_cache, no_diffs):
+    page_n = 0
+    # nothing after the last milestone ever lands in a bucket, so let the
+    # server filter those commits out instead of downloading and skipping them
+    until_str = ms_dates[-1].astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    commits_url = 'https://api.github.com/repos/%s/%s/commits?per_page=100&until=%s' % (user_t, repo_t, until_str)
+    next_page = None
+    while commits_url:
+        commits_req = next_page.result() if next_page else github_get(session, commits_url)
+        commits = loads_response(commits_req)
+        if len(commits) == 0:
+            break
+        # start downloading the next page while this one is processed
+        next_url = commits_req.links.get('next', {}).get('url')
+        next_page = executor.submit(github_get, session, next_url) if next_url else None
+        if not no_diffs:
+            # merge commits get a zero diff below, so don't fetch theirs
+            fetch_diffs(session, executor, prev_diffs, diff_cache, {commit['sha']: commit['url'] for commit in commits if len(commit['parents']) < 2})
+        for commit in commits:
+            # bind the nested sub-dict once; it is read four times below
+            commit_d = commit['commit']
+            author_d = commit.get('author')
+            date_t, date_str = parse_github_date(commit_d['author']['date'])
+            if type(author_d) == dict and 'login' in author_d:
+                author_t = author_d['login']
+            elif type(commit_d.get('author')) == dict and 'name' in commit_d['author']:
+                author_t = commit_d['author']['name']
+            else:
+                author_t = 'unknown'
+            message_t = commit_d['message']
+            coauthors = find_coauthors(message_t)
+            if no_diffs:
+                diff = None
+            elif len(commit['parents']) > 1:
+                diff = {'files': 0, 'total': 0}
+            else:
+                diff = prev_diffs[commit['sha']]
+            add_commit(ms_l, ms_dates, checkpoint_f, date_t, coauthors + [author_t], CommitEntry(message_t, date_str, commit['html_url'], diff))
+        checkpoint_f.flush()
+        page_n += 1
+        if page_n % pages_per_snapshot == 0:
+            snapshot()
+        commits_url = next_url
+
+def iter_pages(session, url):
+    # generator over a paginated list endpoint: yields one page of parsed
+    # items at a time, following Link rel=next, so callers stream pages
+    # instead of managing url/termination state themselves
+    while url:
+        res = github_get(session, url)
+        items = loads_response(res)
+        if len(items) == 0:
+            return
+        yield items
+        url = res.links.get('next', {}).get('url')
+
+def fetch_all_comments(session, user_t, repo_t):
+    # one paginated stream of every issue/PR comment in the repo, instead of
+    # one request per commented issue
+    comments_by_issue = {}
+    comments_url = 'https://api.github.com/repos/%s/%s/issues/comments?per_page=100' % (user_t, repo_t)
+    for comments_res in iter_pages(session, comments_url):
+        for comment in comments_res:
+            comments_by_issue.setdefault(comment['issue_url'], []).append( { 'author': comment['user']['login'], 'body': comment['body'] } )
+    return comments_by_issue
+
+def gather_issues_and_prs(session, user_t, repo_t, ms_dates, ms_l, checkpoint_f, snapshot):
+    page_n = 0
+    comments_by_issue = fetch_all_comments(session, user_t, repo_t)
+    issue_url = 'https://api.github.com/repos/%s/%s/issues?state=all&per_page=100' % (user_t, repo_t)
+    for issues in iter_pages(session, issue_url):
+        for issue in issues:
+            is_pr = 'pull_request' in issue
+            key_t = 'prs' if is_pr else 'issues'
+            date_t, date_str = parse_github_date(issue['created_at'])
+            title_t = issue['title']
+            desc_t = issue['body']
+            labels = issue['labels']
+            label_l = [label['name'] for label in labels]
+            assignees = issue['assignees']
+            assignee_l = [assignee['login'] for assignee in assignees]
+            author_t = issue['user']['login']
+            comments = comments_by_issue.get(issue['url'], [])
+            html_url = issue['html_url']
+            d = { 'title': title_t, 'desc': desc_t, 'date': date_str, 'labels': label_l, 'assignees': assignee_l, 'link': html_url, 'state': issue['state'], 'comments': comments }
+            if is_pr:
+                # the PR object itself carries the aggregate diff stats; one
+                # request replaces the old per-commit get_diff walk that kept
+                # this block commented out as too expensive
+                pr_res = loads_response(github_get(session, issue['pull_request']['url']))
+                d['diff'] = {'files': pr_res['changed_files'], 'total': pr_res['additions'] + pr_res['deletions']}
+            add_issue(ms_l, ms_dates, checkpoint_f, key_t, date_t, author_t, d)
+        checkpoint_f.flush()
+        page_n += 1
+        if page_n % pages_per_snapshot == 0:
+            snapshot()
+
+by_date = itemgetter('date')
+
+def finalize_repo_data(ms_l, ms_dates):
+    for i, ms_date in enumerate(ms_dates):
+        for key_t in ['commits', 'issues', 'prs']:
+            if key_t in ms_l[i].keys():
+                # expand compact commit rows, then sort each author's entries
+                # by date, in place
+                for author_t in ms_l[i][key_t].keys():
+                    bucket = ms_l[i][key_t][author_t]
+                    if key_t == 'commits':
+                        bucket['list'] = [entry._asdict() for entry in bucket['list']]
+                    bucket['list'].sort(key=by_date)
+                # rebuild with authors in key order; keys are unique so the
+                # item tuples never compare beyond the author name
+                ms_l[i][key_t] = dict(sorted(ms_l[i][key_t].items()))
+
+def process_repo(session, tuple_t, ms_dates, data_path, diff_cache, no_diffs):
+    print('Gathering data for %s' % tuple_t)
+    user_t, repo_t = tuple_t.split('/')
+    ms_l = [{'date': ms_date.strftime('%Y-%m-%d %H:%M:%S'), 'commits': {}, 'issues': {}, 'prs': {}} for ms_date in ms_dates]
+    repo_url = 'https://api.github.com/repos/%s/%s' % (user_t, repo_t)
+    repo_req = github_get(session, repo_url)
+    repo_res = loads_response(repo_req)
+    if 'message' in repo_res and repo_res['message'] == 'Not Found':
+        return
+    repo_path = data_path / ('%s-%s.json' % (user_t, repo_t))
+    # append-only checkpoint: one line per gathered record, so a crash loses
+    # nothing and no page triggers a full rewrite of the accumulated state;
+    # it is unlinked only after a completed run, so a leftover one marks
+    # repo_path as a partial mid-run snapshot
+    checkpoint_path = repo_path.with_suffix('.jsonl')
+    # idle repos cost zero further requests: if the last run completed and
+    # nothing was pushed or updated since its output was written, the data
+    # cannot have changed
+    last_activity = max(repo_res.get('pushed_at') or '', repo_res.get('updated_at') or '')
+    if last_activity and repo_path.exists() and not checkpoint_path.exists():
+        activity_t, _ = parse_github_date(last_activity)
+        if activity_t.timestamp() < repo_path.stat().st_mtime:
+            print('Skipping %s, unchanged since last run' % tuple_t)
+            return
+    prev_diffs = {}
+    snapshot = lambda: write_json(repo_path, jsonable(ms_l))
+    with checkpoint_path.open('w', encoding='utf-8') as checkpoint_f:
+        # GraphQL needs a token; without one fall back to REST + per-commit diffs
+        if 'Authorization' in session.headers:
+            gather_commits_graphql(session, user_t, repo_t, ms_dates, ms_l, checkpoint_f, snapshot)
+        else:
+            with ThreadPoolExecutor(max_workers=diff_workers) as executor:
+                gather_commits(session, executor, user_t, repo_t, ms_dates, ms_l, checkpoint_f, snapshot, prev_diffs, diff_cache, no_diffs)
+        print('Finished gathering commits for %s' % tuple_t)
+        if 'Authorization' in session.headers:
+            gather_issues_and_prs_graphql(session, user_t, repo_t, ms_dates, ms_l, checkpoint_f, snapshot)
+        else:
+            gather_issues_and_prs(session, user_t, repo_t, ms_dates, ms_l, checkpoint_f, snapshot)
+        print('Finished gathering issues and PRs for %s' % tuple_t)
+    finalize_repo_data(ms_l, ms_dates)
+    write_json(repo_path, ms_l)
+    checkpoint_path.unlink()
+    print('Finished gathering all data for %s' % tuple_t)
+
+def process_repos(session, repo_l, ms_dates, data_path, no_diffs=False):
+    diff_cache = shelve.open(str(data_path / '.diff_cache'))
+    load_etag_cache(data_path)
+    with ThreadPoolExecutor(max_workers=repo_workers) as pool:
+        for _ in pool.map(lambda tuple_t: process_repo(session, tuple_t, ms_dates, data_path, diff_cache, no_diffs), repo_l):
+            pass
+    diff_cache.close()
+    save_etag_cache(data_path)
 
 def main():
     args = get_args()
 
-    coauthor_pattern = re.compile(r'Co-authored-by: (.*) <.*>')
-
     ms_dates = [
         {'year': 2024, 'month': 3, 'day': 19, 'hour': 22, 'minute': 0, 'second': 0},
         {'year': 2024, 'month': 4, 'day': 30, 'hour': 22, 'minute': 0, 'second': 0},
@@ -51,146 +616,8 @@ def main():
     if not data_path.exists():
         os.mkdir(data_path)
 
-    token_path = Path(args.token)
-    token = None
-    if not token_path.exists():
-        token_needed = input('Do you need to access private repositories? (y/n): ')
-        if token_needed == 'y':
-            token = input('Enter your GitHub token: ')
-            with token_path.open('w') as f:
-                json.dump({'token': token}, f, ensure_ascii=False, indent=4)
-    else:
-        with token_path.open() as f:
-            content = json.load(f)
-            if 'token' not in content.keys():
-                print('Please add your GitHub token to the `token.json` file in the following format: {"token": "your_token"}')
-                exit()
-            token = content['token']
-    headers = { 'Accept': 'application/vnd.github.v3+json' }
-    if token:
-        headers['Authorization'] = 'Bearer {}'.format(token)
-
-    for tuple_t in repo_l:
-        print('Gathering data for %s' % tuple_t)
-        user_t, repo_t = tuple_t.split('/')
-        ms_l = [{'date': ms_date.strftime('%Y-%m-%d %H:%M:%S'), 'commits': {}, 'issues': {}, 'prs': {}} for ms_date in ms_dates]
-        repo_url = 'https://api.github.com/repos/%s/%s' % (user_t, repo_t)
-        repo_req = requests.get(repo_url, headers=headers)
-        repo_res = repo_req.json()
-        if 'message' in repo_res.keys() and repo_res['message'] == 'Not Found':
-            continue
-        page_n = 1
-        repo_path = data_path / ('%s-%s.json' % (user_t, repo_t))
-        prev_diffs = {}
-        while 1:
-            commits_url = 'https://api.github.com/repos/%s/%s/commits?page=%s' % (user_t, repo_t, page_n)
-            commits_req = requests.get(commits_url, headers=headers)
-            commits = commits_req.json()
-            if len(commits) == 0:
-                break
-            for commit in commits:
-                commit_url = commit['url']
-                date_t = commit['commit']['author']['date']
-                date_t = datetime.fromisoformat(date_t.replace('Z', '+00:00'))
-                date_str = (date_t + timedelta(hours=3)).strftime('%Y-%m-%d %H:%M:%S')
-                if 'author' in commit.keys() and type(commit['author']) == dict and 'login' in commit['author'].keys():
-                    author_t = commit['author']['login']
-                elif 'commit' in commit.keys() and type(commit['commit']) == dict and 'author' in commit['commit'].keys() and type(commit['commit']['author']) == dict and 'name' in commit['commit']['author'].keys():
-                    author_t = commit['commit']['author']['name']
-                else:
-                    author_t = 'unknown'
-                message_t = commit['commit']['message']
-                coauthors = coauthor_pattern.findall(message_t)
-                html_url = commit['html_url']
-                diff = get_diff(commit_url, headers)
-                sha = commit['sha']
-                prev_diffs[sha] = diff
-                diff = {'files': len(diff['filenames']), 'total': diff['total']}
-                for i, ms_date in enumerate(ms_dates):
-                    if date_t < ms_date:
-                        for author_t in coauthors + [author_t]:
-                            if author_t not in ms_l[i]['commits'].keys():
-                                ms_l[i]['commits'][author_t] = { 'count': 0, 'list': [] }
-                            ms_l[i]['commits'][author_t]['list'].append({ 'message': message_t, 'date': date_str, 'link': html_url, 'diff': diff})
-                            ms_l[i]['commits'][author_t]['count'] += 1
-                        break
-            with repo_path.open('w') as f:
-                json.dump(ms_l, f, ensure_ascii=False, indent=4)
-            page_n += 1
-        print('Finished gathering commits for %s' % tuple_t)
-        page_n = 1
-        while 1:
-            issue_url = 'https://api.github.com/repos/%s/%s/issues?state=all&page=%s' % (user_t, repo_t, page_n)
-            iss_req = requests.get(issue_url, headers=headers)
-            issues = iss_req.json()
-            if len(issues) == 0:
-                break
-            for issue in issues:
-                is_pr = 'pull_request' in issue.keys()
-                key_t = 'prs' if is_pr else 'issues'
-                date_t = datetime.fromisoformat(issue['created_at'].replace('Z', '+00:00'))
-                date_str = (date_t + timedelta(hours=3)).strftime('%Y-%m-%d %H:%M:%S')
-                title_t = issue['title']
-                desc_t = issue['body']
-                labels = issue['labels']
-                label_l = [label['name'] for label in labels]
-                assignees = issue['assignees']
-                assignee_l = [assignee['login'] for assignee in assignees]
-                author_t = issue['user']['login']
-                comments = []
-                if issue['comments']:
-                    comments_url = issue['comments_url']
-                    comments_req = requests.get(comments_url, headers=headers)
-                    comments_res = comments_req.json()
-                    for comment in comments_res:
-                        comments.append( { 'author': comment['user']['login'], 'body': comment['body'] } )
-                html_url = issue['html_url']
-                # if is_pr:
-                #     commits_url = issue['pull_request']['url'] + '/commits'
-                #     commits_req = requests.get(commits_url, headers=headers)
-                #     commits_res = commits_req.json()
-                #     urls = {commit['sha']: commit['url'] for commit in commits_res}
-                #     diffs = []
-                #     for sha, url in urls.items():
-                #         if sha not in prev_diffs.keys():
-                #             diff = get_diff(url, headers)
-                #             prev_diffs[sha] = diff
-                #         else:
-                #             diff = prev_diffs[sha]
-                #         diffs.append(diff)
-                #     diff_d = {'files': set(), 'total': sum([diff['total'] for diff in diffs])}
-                #     for diff in diffs:
-                #         for filename in diff['filenames']:
-                #             diff_d['files'].add(filename)
-                #     diff_d['files'] = len(diff_d['files'])
-                for i, ms_date in enumerate(ms_dates):
-                    if date_t < ms_date:
-                        if author_t not in ms_l[i][key_t].keys():
-                            ms_l[i][key_t][author_t] = { 'count': 0, 'list': [] }
-                        d = { 'title': title_t, 'desc': desc_t, 'date': date_str, 'labels': label_l, 'assignees': assignee_l, 'link': html_url, 'state': issue['state'], 'comments': comments }
-                        # if is_pr:
-                        #     d['diff'] = diff_d
-                        ms_l[i][key_t][author_t]['list'].append(d)
-                        ms_l[i][key_t][author_t]['count'] += 1
-                        break
-            with repo_path.open('w') as f:
-                json.dump(ms_l, f, ensure_ascii=False, indent=4)
-            page_n += 1
-        print('Finished gathering issues and PRs for %s' % tuple_t)
-        # sort by date
-        for i, ms_date in enumerate(ms_dates):
-            for key_t in ['commits', 'issues', 'prs']:
-                if key_t in ms_l[i].keys():
-                    for author_t in ms_l[i][key_t].keys():
-                        ms_l[i][key_t][author_t]['list'] = sorted(ms_l[i][key_t][author_t]['list'], key=lambda x: x['date'])
-        # sort keys
-        for i, ms_date in enumerate(ms_dates):
-            for key_t in ['commits', 'issues', 'prs']:
-                if key_t in ms_l[i].keys():
-                    ms_l[i][key_t] = dict(sorted(ms_l[i][key_t].items(), key=lambda x: x[0]))
-        with repo_path.open('w') as f:
-            json.dump(ms_l, f, ensure_ascii=False, indent=4)
-        print('Finished gathering all data for %s' % tuple_t)
+    session = setup_github_auth(Path(args.token))
+    process_repos(session, repo_l, ms_dates, data_path, args.no_diffs)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
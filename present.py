@@ -1,28 +1,47 @@
 import argparse, json
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 def get_args():
     parser = argparse.ArgumentParser(description='Gather commits and issues from GitHub repositories')
     parser.add_argument('-i', '--input', help='Path to the input file', type=str, required=True)
     parser.add_argument('-m', '--milestone', type=int, help='Milestone number', required=True)
     return parser.parse_args()
 
+def extract_milestone(text, n):
+    # decode array elements one at a time and stop at the requested one, so
+    # earlier and later milestones are never materialized
+    decoder = json.JSONDecoder()
+    i = text.index('[') + 1
+    for _ in range(n):
+        while text[i] in ' \t\r\n,':
+            i += 1
+        obj, i = decoder.raw_decode(text, i)
+    return obj
+
 def main():
     args = get_args()
 
     input_file = Path(args.input)
-    with input_file.open() as f:
-        data = json.load(f)
-    
-    ms = data[args.milestone - 1]
+    if orjson:
+        ms = orjson.loads(input_file.read_bytes())[args.milestone - 1]
+    else:
+        ms = extract_milestone(input_file.read_text(), args.milestone)
 
     input_file_stem = input_file.stem
     output_file = input_file.with_name(f'{input_file_stem}-milestone-{args.milestone}.json')
 
-    with output_file.open('w') as f:
-        json.dump(ms, f, ensure_ascii=False, indent=4)
-    
+    if orjson:
+        output_file.write_bytes(orjson.dumps(ms, option=orjson.OPT_INDENT_2))
+    else:
+        with output_file.open('w') as f:
+            json.dump(ms, f, ensure_ascii=False, indent=4)
+
     print(f'Milestone {args.milestone} saved to {output_file}')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()